@@ -0,0 +1,14 @@
+import os
+import sys
+import tempfile
+
+# Entorno mínimo antes de importar el script: sin tienda real, log y estado fuera del repo
+_TMP = tempfile.mkdtemp(prefix="estado-tests-")
+os.environ.update(
+    SHOP_URL="https://tienda-test.myshopify.com",
+    SHOPIFY_ACCESS_TOKEN="test",
+    STATE_DIR=_TMP,
+    LOG_FILE=os.path.join(_TMP, "log.txt"),
+    TZ_NAME="Europe/Madrid",
+)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
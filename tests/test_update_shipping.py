@@ -0,0 +1,199 @@
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+import update_shipping as us
+
+
+@pytest.fixture
+def conn():
+    c = sqlite3.connect(":memory:")
+    us.db_init(c)
+    yield c
+    c.close()
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(us.time, "monotonic", fake.monotonic)
+    monkeypatch.setattr(us.time, "sleep", fake.sleep)
+    return fake
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, body=None, headers=None):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers or {}
+        self.links = {}
+        self.text = ""
+
+
+# =========================
+# db_update_checks
+# =========================
+def check(**kwargs):
+    row = {
+        "order_id": 1,
+        "fulfillment_id": 10,
+        "checked_at": "2024-05-03T10:00:00+02:00",
+        "delivered": False,
+        "delivered_at": None,
+        "ctt_status": "En reparto",
+        "ctt_event_at": None,
+        "shopify_status": "out_for_delivery",
+        "next_check_at": None,
+        "last_error": None,
+    }
+    row.update(kwargs)
+    return us.check_row(row)
+
+
+def shipment(conn):
+    return conn.execute(
+        "SELECT is_delivered, delivered_at, last_ctt_status, events_etag, events_statuses FROM shipments"
+    ).fetchone()
+
+
+def test_db_update_checks_keeps_first_delivery_and_events_cache(conn):
+    us.db_upsert_shipments(conn, [(1, 10, "T1", None)])
+
+    us.db_update_checks(conn, [check(events_cache=('"v1"', "in_transit,out_for_delivery"))])
+    assert shipment(conn) == (0, None, "En reparto", '"v1"', "in_transit,out_for_delivery")
+
+    # Sin events_cache (None) se conserva la caché guardada
+    us.db_update_checks(conn, [check(ctt_status="Entregado", delivered=True, delivered_at="2024-05-03T12:00:00")])
+    assert shipment(conn) == (1, "2024-05-03T12:00:00", "Entregado", '"v1"', "in_transit,out_for_delivery")
+
+    # Una segunda entrega no pisa delivered_at y un resultado no entregado no lo reabre
+    us.db_update_checks(
+        conn,
+        [check(delivered=True, delivered_at="2024-05-04T09:00:00"), check(delivered=False)],
+    )
+    assert shipment(conn)[:2] == (1, "2024-05-03T12:00:00")
+
+
+# =========================
+# RateLimiter
+# =========================
+def test_rate_limiter_burst_then_rate(clock):
+    limiter = us.RateLimiter(rate=2, burst=3)
+    for _ in range(3):
+        limiter.acquire()
+    assert clock.sleeps == []
+
+    limiter.acquire()
+    assert clock.sleeps == [pytest.approx(0.5)]
+
+
+def test_rate_limiter_pause_delays_next_request(clock):
+    limiter = us.RateLimiter(rate=2, burst=3)
+    limiter.pause(5)
+    limiter.acquire()
+    assert clock.sleeps == [pytest.approx(5)]
+
+
+def test_rate_limiter_adapts_to_throttling(clock):
+    limiter = us.RateLimiter(rate=2, burst=1)
+    for _ in range(5):
+        limiter.on_throttled()
+    assert limiter.interval == pytest.approx(limiter.base_interval * 8)
+
+    limiter.on_success()
+    assert limiter.interval == pytest.approx(limiter.base_interval * 8 * 0.9)
+    for _ in range(50):
+        limiter.on_success()
+    assert limiter.interval == limiter.base_interval
+
+
+# =========================
+# Descubrimiento: marca updated_at
+# =========================
+ORDERS = [  # (id, created_at, updated_at)
+    (1, "2024-05-01T08:00:00Z", "2024-05-03T11:00:00Z"),
+    (2, "2024-05-01T09:00:00Z", "2024-05-03T12:00:00Z"),
+    (3, "2024-05-01T10:00:00Z", "2024-05-03T11:30:00Z"),
+]
+
+
+def fake_orders_get(url, params=None):
+    """orders.json en memoria: respeta updated_at_min, order y limit."""
+    rows = list(ORDERS)
+    if params.get("updated_at_min"):
+        since = datetime.fromisoformat(params["updated_at_min"])
+        rows = [o for o in rows if datetime.fromisoformat(o[2]) >= since]
+    field, direction = params["order"].split()
+    rows.sort(key=lambda o: o[1] if field == "created_at" else o[2], reverse=direction == "desc")
+    orders = [
+        {"id": oid, "updated_at": updated, "fulfillments": [{"id": 100 + oid, "tracking_number": f"T{oid}", "created_at": created}]}
+        for oid, created, updated in rows[: params["limit"]]
+    ]
+    return FakeResponse(body={"orders": orders})
+
+
+def test_discovery_watermark_does_not_skip_truncated_orders(conn, monkeypatch):
+    monkeypatch.setattr(us, "shopify_get", fake_orders_get)
+    monkeypatch.setattr(us, "json_body", lambda r: r.body)
+    monkeypatch.setattr(us, "SHOPIFY_DISCOVERY", "rest")
+    monkeypatch.setattr(us, "MAX_SHOPIFY_ORDERS", 2)
+    monkeypatch.setattr(us, "DISCOVERY_OVERLAP_MINUTES", 0)
+    us.db_set_state(conn, "last_orders_updated_at", "2024-05-03T10:00:00+00:00")
+
+    us.discover_shipments_from_shopify(conn)
+    assert {r[0] for r in conn.execute("SELECT order_id FROM shipments")} == {1, 3}
+    assert us.db_get_state(conn, "last_orders_updated_at") == "2024-05-03T11:30:00+00:00"
+
+    us.discover_shipments_from_shopify(conn)
+    assert {r[0] for r in conn.execute("SELECT order_id FROM shipments")} == {1, 2, 3}
+    assert us.db_get_state(conn, "last_orders_updated_at") == "2024-05-03T12:00:00+00:00"
+
+
+# =========================
+# Eventos de fulfillment
+# =========================
+def test_graphql_events_to_rest_format():
+    connection = {"edges": [{"node": {"status": "OUT_FOR_DELIVERY"}}, {"node": {"status": "IN_TRANSIT"}}]}
+    assert us.graphql_events(connection) == [{"status": "in_transit"}, {"status": "out_for_delivery"}]
+    assert us.graphql_events(None) == []
+
+
+def test_get_fulfillment_events_rebuilds_from_cache_on_304(monkeypatch):
+    sent = {}
+
+    def fake_request(method, url, headers=None, **kwargs):
+        sent["headers"] = headers
+        return FakeResponse(status_code=304)
+
+    monkeypatch.setattr(us, "shopify_request", fake_request)
+    events, etag = us.get_fulfillment_events(1, 10, '"v1"', "in_transit,out_for_delivery")
+    assert sent["headers"] == {"If-None-Match": '"v1"'}
+    assert events == [{"status": "in_transit"}, {"status": "out_for_delivery"}]
+    assert etag == '"v1"'
+
+
+def test_get_fulfillment_events_unconditional_without_cache(monkeypatch):
+    sent = {}
+
+    def fake_request(method, url, headers=None, **kwargs):
+        sent["headers"] = headers
+        return FakeResponse(body={"events": [{"status": "in_transit"}]}, headers={"ETag": '"v2"'})
+
+    monkeypatch.setattr(us, "shopify_request", fake_request)
+    monkeypatch.setattr(us, "json_body", lambda r: r.body)
+    assert us.get_fulfillment_events(1, 10, '"v1"', None) == ([{"status": "in_transit"}], '"v2"')
+    assert sent["headers"] == {}
@@ -1,29 +1,71 @@
 import os
+import sys
 import time
 import random
+import functools
+import unicodedata
+import atexit
+import queue
+import logging
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 import sqlite3
+import threading
+import orjson
 import requests
-from datetime import datetime, timedelta
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
-from dateutil.parser import parse
 
 # =========================
 # CONFIG
 # =========================
-SHOP_URL = os.getenv("SHOP_URL", "https://48d471-2.myshopify.com").rstrip("/")
+# Sin valores por defecto: sin entorno no se debe tocar ninguna tienda real
+SHOP_URL = os.getenv("SHOP_URL", "").rstrip("/")
 API_VERSION = os.getenv("SHOPIFY_API_VERSION", "2023-10")
 ACCESS_TOKEN = os.getenv("SHOPIFY_ACCESS_TOKEN")
 
 CTT_API_URL = "https://wct.cttexpress.com/p_track_redis.php?sc="
 
+# URLs de la Admin API precalculadas (la de eventos se formatea con order_id / fulfillment_id)
+_ORDERS_URL = f"{SHOP_URL}/admin/api/{API_VERSION}/orders.json"
+_EVENTS_URL_TEMPLATE = f"{SHOP_URL}/admin/api/{API_VERSION}/orders/{{order_id}}/fulfillments/{{fulfillment_id}}/events.json"
+_GRAPHQL_URL = f"{SHOP_URL}/admin/api/{API_VERSION}/graphql.json"
+
 TZ_NAME = os.getenv("TZ_NAME", "Europe/Madrid")
 TZ = ZoneInfo(TZ_NAME)
 
 LOG_FILE = os.getenv("LOG_FILE", "logs_actualizacion_envios.txt")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", "5000000"))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "3"))
 
 # Pedidos a “descubrir” en Shopify (para meter nuevos envíos en la DB)
 MAX_SHOPIFY_ORDERS = int(os.getenv("MAX_SHOPIFY_ORDERS", "500"))
 
+# "graphql": pedidos + fulfillments + eventos en una sola consulta por página
+# "rest": orders.json paginado (los eventos se piden luego uno a uno)
+SHOPIFY_DISCOVERY = os.getenv("SHOPIFY_DISCOVERY", "graphql").strip().lower()
+# Fulfillments por pedido en la consulta GraphQL; los pedidos que llegan al tope se releen
+# enteros por REST (no se pierde ninguno). Coste por página ≈ first × (1 + N × 14).
+SHOPIFY_GRAPHQL_FULFILLMENTS = 3
+# Coste GraphQL por página ≈ first × (1 + 3 fulfillments × 14) -> 20 queda < 1000 puntos
+SHOPIFY_GRAPHQL_PAGE_SIZE = int(os.getenv("SHOPIFY_GRAPHQL_PAGE_SIZE", "20"))
+# Fulfillments por consulta nodes(ids:) al pedir eventos en lote (≈ 12 puntos cada uno)
+SHOPIFY_NODES_BATCH = int(os.getenv("SHOPIFY_NODES_BATCH", "50"))
+
+# Descubrimiento incremental: solo pedidos actualizados desde el último descubrimiento
+# correcto (menos un margen). La primera ejecución (sin marca en la DB) lo pide todo.
+DISCOVERY_INCREMENTAL = os.getenv("DISCOVERY_INCREMENTAL", "1") == "1"
+DISCOVERY_OVERLAP_MINUTES = int(os.getenv("DISCOVERY_OVERLAP_MINUTES", "60"))
+# Solo pedidos creados en los últimos N días (0 = sin límite). Los envíos ya guardados
+# en la DB se siguen revisando aunque su pedido sea más antiguo.
+DISCOVERY_CUTOFF_DAYS = int(os.getenv("DISCOVERY_CUTOFF_DAYS", "0"))
+
+# Modo dirigido: solo estos pedidos (ids separados por comas), p.ej. lanzado desde el
+# receptor del webhook fulfillments/update. Vacío => barrido normal (cron).
+SYNC_ORDER_IDS = [int(x) for x in os.getenv("SYNC_ORDER_IDS", "").replace(" ", "").split(",") if x]
+
 # Revisión normal: 0 => cada ejecución (dejarlo en 0 suele estar bien)
 NORMAL_RECHECK_MINUTES = int(os.getenv("NORMAL_RECHECK_MINUTES", "0"))
 
@@ -31,19 +73,41 @@ NORMAL_RECHECK_MINUTES = int(os.getenv("NORMAL_RECHECK_MINUTES", "0"))
 CTT_MAX_RETRIES = int(os.getenv("CTT_MAX_RETRIES", "6"))
 CTT_BASE_BACKOFF = float(os.getenv("CTT_BASE_BACKOFF", "0.7"))
 CTT_MAX_BACKOFF = float(os.getenv("CTT_MAX_BACKOFF", "25"))
-CTT_THROTTLE_SECONDS = float(os.getenv("CTT_THROTTLE_SECONDS", "0.8"))
+CTT_MAX_RPS = float(os.getenv("CTT_MAX_RPS", "4"))
+CTT_BURST = int(os.getenv("CTT_BURST", "1"))
+
+# Concurrencia: nº de envíos consultados en paralelo (CTT + Shopify)
+SYNC_WORKERS = max(1, int(os.getenv("SYNC_WORKERS", "4")))
 
-# Shopify (timeouts)
+# Conexiones keep-alive por host (al menos una por worker para no descartar sockets)
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", str(max(10, SYNC_WORKERS))))
+# Shopify lo usan además los hilos de EVENTS_LOOKUP_POOL (otros SYNC_WORKERS)
+SHOPIFY_POOL_MAXSIZE = max(HTTP_POOL_MAXSIZE, 2 * SYNC_WORKERS)
+
+# Shopify (timeouts / límite REST: bucket de 40 que se vacía a 2 req/s)
 SHOPIFY_TIMEOUT = float(os.getenv("SHOPIFY_TIMEOUT", "30"))
+SHOPIFY_MAX_RPS = float(os.getenv("SHOPIFY_MAX_RPS", "2"))
+# Ráfaga inicial: la mitad del bucket (entre ejecuciones se vacía del todo)
+SHOPIFY_BURST = int(os.getenv("SHOPIFY_BURST", "20"))
+SHOPIFY_CALL_LIMIT_THRESHOLD = float(os.getenv("SHOPIFY_CALL_LIMIT_THRESHOLD", "0.8"))
+SHOPIFY_MAX_RETRIES = int(os.getenv("SHOPIFY_MAX_RETRIES", "3"))
+SHOPIFY_BACKOFF = float(os.getenv("SHOPIFY_BACKOFF", "1.0"))
 
 # Estado persistente (SQLite) + carpeta cacheable
 STATE_DIR = os.getenv("STATE_DIR", ".state")
 STATE_DB_PATH = os.getenv("STATE_DB_PATH", os.path.join(STATE_DIR, "shipping_state.sqlite3"))
+# Los db_* no hacen commit: las revisiones se guardan y confirman cada N resultados (y al final)
+DB_COMMIT_EVERY = max(1, int(os.getenv("DB_COMMIT_EVERY", "100")))
 
 # =========================
 # HTTP SESSIONS
 # =========================
+def pooled_adapter(max_retries=0, pool_maxsize: int = HTTP_POOL_MAXSIZE) -> HTTPAdapter:
+    return HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize, max_retries=max_retries)
+
+
 CTT_SESSION = requests.Session()
+CTT_SESSION.mount("https://", pooled_adapter())
 CTT_SESSION.headers.update(
     {
         "User-Agent": "Mozilla/5.0 (compatible; DondeFueBot/1.0)",
@@ -55,91 +119,438 @@ CTT_SESSION.headers.update(
 )
 
 SHOP_SESSION = requests.Session()
+# GET: reintentos 429/5xx con backoff y Retry-After. Los POST no se reintentan aquí
+# (un 5xx puede haber creado ya el evento); el 429 del POST se gestiona en shopify_post.
+SHOP_SESSION.mount(
+    "https://",
+    pooled_adapter(
+        max_retries=Retry(
+            total=SHOPIFY_MAX_RETRIES,
+            backoff_factor=SHOPIFY_BACKOFF,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset({"GET"}),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        ),
+        pool_maxsize=SHOPIFY_POOL_MAXSIZE,
+    ),
+)
+# Cabeceras fijas (token incluido) una sola vez; main() comprueba que haya token
 SHOP_SESSION.headers.update({"Content-Type": "application/json"})
+if ACCESS_TOKEN:
+    SHOP_SESSION.headers["X-Shopify-Access-Token"] = ACCESS_TOKEN
+
+
+# =========================
+# RATE LIMIT
+# =========================
+class RateLimiter:
+    """Token bucket compartido entre hilos: `rate` req/s sostenidas con ráfagas de hasta
+    `burst` peticiones seguidas (se lleva como "hora teórica" de la siguiente, GCRA).
+    Adaptativo: cada 429 reduce el ritmo a la mitad y las respuestas buenas lo recuperan."""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.base_interval = 1.0 / rate if rate > 0 else 0.0
+        self.interval = self.base_interval
+        self.tolerance = self.base_interval * (max(1, burst) - 1)
+        self._lock = threading.Lock()
+        self._next_at = 0.0
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            next_at = max(now, self._next_at)
+            wait = next_at - self.tolerance - now
+            self._next_at = next_at + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """Retrasa la siguiente petición al menos `seconds` (p.ej. bucket casi lleno)."""
+        with self._lock:
+            self._next_at = max(self._next_at, time.monotonic() + seconds + self.tolerance)
+
+    def on_throttled(self):
+        """429: mitad de ritmo (como mucho 1/8 del nominal) y sin ráfaga pendiente."""
+        with self._lock:
+            self.interval = min(self.interval * 2, self.base_interval * 8)
+            self._next_at = max(self._next_at, time.monotonic() + self.tolerance)
+
+    def on_success(self):
+        """Petición aceptada: vuelve poco a poco al ritmo nominal."""
+        if self.interval > self.base_interval:
+            with self._lock:
+                self.interval = max(self.base_interval, self.interval * 0.9)
+
+
+SHOPIFY_LIMITER = RateLimiter(SHOPIFY_MAX_RPS, SHOPIFY_BURST)
+CTT_LIMITER = RateLimiter(CTT_MAX_RPS, CTT_BURST)
+
+# GET de eventos lanzado en paralelo a la consulta CTT del mismo envío (ver process_one).
+# Pool aparte para no bloquear a los workers esperando tareas encoladas detrás de ellos.
+EVENTS_LOOKUP_POOL = ThreadPoolExecutor(max_workers=SYNC_WORKERS, thread_name_prefix="shopify-events")
 
 
 # =========================
 # LOG
 # =========================
+# Un único fichero abierto toda la ejecución (logging lo cierra/vacía al salir)
+LOGGER = logging.getLogger("update_shipping")
+LOGGER.setLevel(logging.INFO)
+LOGGER.propagate = False
+
+
+class TZFormatter(logging.Formatter):
+    """%(asctime)s en TZ_NAME (el runner de CI va en UTC); solo se formatea al emitir y una
+    vez por segundo (las líneas del mismo segundo reutilizan el texto)."""
+
+    _cached_second = None
+    _cached_text = ""
+
+    def formatTime(self, record, datefmt=None):
+        second = int(record.created)
+        if second != self._cached_second:
+            self._cached_text = datetime.fromtimestamp(second, TZ).strftime(datefmt or "%Y-%m-%d %H:%M:%S")
+            self._cached_second = second
+        return self._cached_text
+
+
+_file_handler = RotatingFileHandler(
+    LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8", delay=True
+)
+_file_handler.setFormatter(TZFormatter("[%(asctime)s] %(message)s", "%Y-%m-%d %H:%M:%S"))
+
+_console_handler = logging.StreamHandler(sys.stdout)
+_console_handler.setFormatter(logging.Formatter("%(message)s"))
+
+# Los hilos de trabajo solo encolan; un hilo aparte escribe en fichero y consola
+_log_queue = queue.SimpleQueue()
+LOGGER.addHandler(QueueHandler(_log_queue))
+_log_listener = QueueListener(_log_queue, _file_handler, _console_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)  # vacía la cola antes del cierre de logging
+
+
 def log(message: str):
-    ts = datetime.now(TZ).strftime("%Y-%m-%d %H:%M:%S")
-    try:
-        with open(LOG_FILE, "a", encoding="utf-8") as f:
-            f.write(f"[{ts}] {message}\n")
-    except Exception:
-        pass
-    print(message)
+    LOGGER.info(message)
 
 
 def safe_snippet(text: str, n: int = 220) -> str:
     return (text or "")[:n].replace("\n", " ").replace("\r", " ")
 
 
+def json_body(r: requests.Response):
+    """Decodifica el cuerpo con orjson directamente desde bytes (sin pasar por r.text)."""
+    return orjson.loads(r.content)
+
+
 # =========================
 # SHOPIFY HELPERS
 # =========================
-def shopify_headers():
-    if not ACCESS_TOKEN:
-        raise RuntimeError("Falta SHOPIFY_ACCESS_TOKEN en el entorno")
-    return {"X-Shopify-Access-Token": ACCESS_TOKEN, "Content-Type": "application/json"}
+def observe_shopify_call_limit(r: requests.Response):
+    """Lee X-Shopify-Shop-Api-Call-Limit ("38/40") y frena si el bucket va casi lleno."""
+    header = r.headers.get("X-Shopify-Shop-Api-Call-Limit")
+    if not header:
+        return
+    try:
+        used, size = (int(x) for x in header.split("/", 1))
+    except ValueError:
+        return
+    excess = used - size * SHOPIFY_CALL_LIMIT_THRESHOLD
+    if excess > 0 and SHOPIFY_MAX_RPS > 0:
+        SHOPIFY_LIMITER.pause(excess / SHOPIFY_MAX_RPS)
+
+
+def was_throttled(r: requests.Response) -> bool:
+    """429 en la respuesta final o en alguno de los reintentos automáticos de urllib3."""
+    if r.status_code == 429:
+        return True
+    retries = getattr(r.raw, "retries", None)
+    return any(h.status == 429 for h in (retries.history if retries else ()))
+
+
+def shopify_request(method: str, url: str, headers: dict | None = None, **kwargs):
+    SHOPIFY_LIMITER.acquire()
+    r = SHOP_SESSION.request(method, url, headers=headers, timeout=SHOPIFY_TIMEOUT, **kwargs)
+    observe_shopify_call_limit(r)
+    if was_throttled(r):
+        SHOPIFY_LIMITER.on_throttled()
+    elif r.status_code < 400:
+        SHOPIFY_LIMITER.on_success()
+    return r
 
 
 def shopify_get(url: str, params=None):
-    r = SHOP_SESSION.get(url, headers=shopify_headers(), params=params, timeout=SHOPIFY_TIMEOUT)
+    r = shopify_request("GET", url, params=params)
     r.raise_for_status()
     return r
 
 
+def retry_after_seconds(r: requests.Response) -> float | None:
+    try:
+        return max(0.0, float(r.headers["Retry-After"]))
+    except (KeyError, ValueError):
+        return None
+
+
 def shopify_post(url: str, payload: dict):
-    r = SHOP_SESSION.post(url, headers=shopify_headers(), json=payload, timeout=SHOPIFY_TIMEOUT)
-    return r
+    # Solo se reintenta el 429: Shopify no ha procesado la petición, no hay riesgo de duplicar.
+    for attempt in range(SHOPIFY_MAX_RETRIES + 1):
+        r = shopify_request("POST", url, data=orjson.dumps(payload))
+        if r.status_code != 429 or attempt == SHOPIFY_MAX_RETRIES:
+            return r
+        # Jitter para que los workers que chocan a la vez no reintenten todos a la vez
+        retry_after = retry_after_seconds(r)
+        if retry_after is not None:
+            wait = retry_after + random.uniform(0, SHOPIFY_BACKOFF)
+        else:
+            wait = random.uniform(0, SHOPIFY_BACKOFF * (2 ** (attempt + 1)))
+        log(f"⏳ Shopify POST 429. Reintento {attempt + 1}/{SHOPIFY_MAX_RETRIES} en {wait:.2f}s")
+        SHOPIFY_LIMITER.pause(wait)
 
 
-def get_fulfilled_orders(limit=500):
-    """Obtiene hasta 'limit' pedidos con fulfillments (fulfilled)."""
-    all_orders = []
-    url = f"{SHOP_URL}/admin/api/{API_VERSION}/orders.json"
+# Campos de cada fulfillment REST que usa el descubrimiento (el resto, p.ej. line_items, sobra)
+_FULFILLMENT_KEYS = ("id", "tracking_number", "tracking_numbers", "shipped_at", "created_at", "shipment_status")
+
+
+def iter_fulfilled_orders(
+    limit=500, updated_at_min: str | None = None, created_at_min: str | None = None, ids: list | None = None
+):
+    """Genera hasta 'limit' pedidos con fulfillments (fulfilled), página a página,
+    opcionalmente solo los actualizados desde 'updated_at_min' / creados desde
+    'created_at_min' (ISO-8601) o solo 'ids'.
+
+    Con 'updated_at_min' van por updated_at ascendente: si 'limit' corta, lo que queda
+    es lo más reciente y la marca (mayor updated_at leído) no salta pedidos sin leer."""
+    remaining = limit
+    url = _ORDERS_URL
     params = {
         "fulfillment_status": "fulfilled",
         "status": "any",
-        "limit": 50,
-        "order": "created_at desc",
+        "limit": min(limit, 250),  # 250 = máximo de la REST API
+        "order": "updated_at asc" if updated_at_min else "created_at desc",
+        # Solo lo que lee discover_shipments_from_shopify (el pedido completo pesa decenas de KB)
+        "fields": "id,updated_at,fulfillments",
     }
-
-    while len(all_orders) < limit:
+    if updated_at_min:
+        params["updated_at_min"] = updated_at_min
+    if created_at_min:
+        params["created_at_min"] = created_at_min
+    if ids:
+        params["ids"] = ",".join(str(i) for i in ids)
+
+    while remaining > 0:
         r = shopify_get(url, params=params)
-        data = r.json()
-        orders = data.get("orders", [])
+        data = json_body(r)
+        orders = data.get("orders", [])[:remaining]
         if not orders:
             break
 
-        all_orders.extend(orders)
+        for order in orders:
+            yield {
+                "id": order.get("id"),
+                "updated_at": order.get("updated_at"),
+                "fulfillments": [{k: f.get(k) for k in _FULFILLMENT_KEYS} for f in order.get("fulfillments") or []],
+            }
+        remaining -= len(orders)
 
-        # Paginación (Link header)
-        if "Link" in r.headers and 'rel="next"' in r.headers["Link"]:
-            url = r.links["next"]["url"]
-            params = None
-        else:
+        # Paginación (Link header; r.links es {} si no hay cabecera)
+        next_url = r.links.get("next", {}).get("url")
+        if not next_url:
             break
+        url, params = next_url, None
+
+
+FULFILLED_ORDERS_QUERY = """
+query FulfilledOrders(
+  $first: Int!, $after: String, $query: String, $sortKey: OrderSortKeys!, $reverse: Boolean!, $fulfillments: Int!
+) {
+  orders(first: $first, after: $after, query: $query, sortKey: $sortKey, reverse: $reverse) {
+    pageInfo { hasNextPage endCursor }
+    edges {
+      node {
+        legacyResourceId
+        updatedAt
+        fulfillments(first: $fulfillments) {
+          legacyResourceId
+          createdAt
+          displayStatus
+          trackingInfo(first: 1) { number }
+          events(first: 10, sortKey: HAPPENED_AT, reverse: true) { edges { node { status } } }
+        }
+      }
+    }
+  }
+}
+"""
+
+
+def shopify_graphql(query: str, variables: dict | None = None) -> dict:
+    """POST a la Admin GraphQL API. Respeta el bucket de coste (throttleStatus) y reintenta THROTTLED."""
+    payload = {"query": query, "variables": variables or {}}
+    for attempt in range(SHOPIFY_MAX_RETRIES + 1):
+        r = shopify_post(_GRAPHQL_URL, payload)
+        r.raise_for_status()
+        body = json_body(r)
+
+        # Si no queda coste para otra consulta igual, esperamos a que se rellene el bucket
+        cost = (body.get("extensions") or {}).get("cost") or {}
+        throttle = cost.get("throttleStatus") or {}
+        requested = cost.get("requestedQueryCost") or 0
+        available = throttle.get("currentlyAvailable")
+        restore = throttle.get("restoreRate") or 0
+        wait = 0.0
+        if available is not None and restore and available < requested:
+            wait = (requested - available) / restore
+            SHOPIFY_LIMITER.pause(wait)
+
+        errors = body.get("errors")
+        if not errors:
+            return body.get("data") or {}
+
+        throttled = any(
+            isinstance(e, dict) and (e.get("extensions") or {}).get("code") == "THROTTLED" for e in errors
+        )
+        if not throttled or attempt == SHOPIFY_MAX_RETRIES:
+            raise RuntimeError(f"GraphQL Shopify: {safe_snippet(str(errors), 300)}")
+        wait = max(wait, SHOPIFY_BACKOFF * (2 ** attempt))
+        log(f"⏳ GraphQL Shopify THROTTLED. Reintento {attempt + 1}/{SHOPIFY_MAX_RETRIES} en {wait:.2f}s")
+        SHOPIFY_LIMITER.pause(wait)
 
-    return all_orders[:limit]
 
+def gid_to_int(value) -> int | None:
+    """'gid://shopify/Order/123' o '123' -> 123."""
+    if value is None:
+        return None
+    try:
+        return int(str(value).rsplit("/", 1)[-1])
+    except ValueError:
+        return None
+
+
+def graphql_events(connection: dict | None) -> list:
+    """Eventos GraphQL (más recientes primero, en MAYÚSCULAS) -> formato REST: en orden
+    cronológico y con el status en minúsculas."""
+    return [
+        {"status": (e.get("node") or {}).get("status", "").lower()}
+        for e in reversed((connection or {}).get("edges") or [])
+    ]
+
+
+def iter_fulfilled_orders_graphql(limit=500, updated_at_min: str | None = None, created_at_min: str | None = None):
+    """Como iter_fulfilled_orders pero vía GraphQL: cada fulfillment trae ya sus eventos
+    ("events", en minúsculas como en REST), así que no hace falta pedirlos uno a uno."""
+    remaining = limit
+    search = "fulfillment_status:fulfilled"
+    if updated_at_min:
+        search += f" updated_at:>='{updated_at_min}'"
+    if created_at_min:
+        search += f" created_at:>='{created_at_min}'"
+    variables = {
+        "first": SHOPIFY_GRAPHQL_PAGE_SIZE,
+        "after": None,
+        "query": search,
+        # Mismo orden que la versión REST (ver iter_fulfilled_orders)
+        "sortKey": "UPDATED_AT" if updated_at_min else "CREATED_AT",
+        "reverse": not updated_at_min,
+        "fulfillments": SHOPIFY_GRAPHQL_FULFILLMENTS,
+    }
+
+    while remaining > 0:
+        data = shopify_graphql(FULFILLED_ORDERS_QUERY, variables)
+        conn_orders = data.get("orders") or {}
+        edges = (conn_orders.get("edges") or [])[:remaining]
+        if not edges:
+            break
 
-def get_fulfillment_events(order_id: int, fulfillment_id: int):
-    url = f"{SHOP_URL}/admin/api/{API_VERSION}/orders/{order_id}/fulfillments/{fulfillment_id}/events.json"
-    r = SHOP_SESSION.get(url, headers=shopify_headers(), timeout=SHOPIFY_TIMEOUT)
+        for edge in edges:
+            node = edge.get("node") or {}
+            order_id = gid_to_int(node.get("legacyResourceId"))
+            if order_id and len(node.get("fulfillments") or []) >= SHOPIFY_GRAPHQL_FULFILLMENTS:
+                # Puede tener más de los que trae la consulta: el pedido completo por REST
+                log(f"ℹ️ Pedido {order_id}: {SHOPIFY_GRAPHQL_FULFILLMENTS}+ fulfillments, lo releo por REST")
+                yield from iter_fulfilled_orders(limit=1, ids=[order_id])
+                continue
+            fulfillments = []
+            for f in node.get("fulfillments") or []:
+                tracking = [t.get("number") for t in (f.get("trackingInfo") or []) if t.get("number")]
+                fulfillments.append(
+                    {
+                        "id": gid_to_int(f.get("legacyResourceId")),
+                        "tracking_number": tracking[0] if tracking else None,
+                        "created_at": f.get("createdAt"),
+                        # Mismo valor que shipment_status en REST ("delivered", "in_transit"...)
+                        "shipment_status": (f.get("displayStatus") or "").lower() or None,
+                        "events": graphql_events(f.get("events")),
+                    }
+                )
+            yield {
+                "id": order_id,
+                "updated_at": node.get("updatedAt"),
+                "fulfillments": fulfillments,
+            }
+        remaining -= len(edges)
+
+        page_info = conn_orders.get("pageInfo") or {}
+        if not page_info.get("hasNextPage"):
+            break
+        variables["after"] = page_info.get("endCursor")
+
+
+FULFILLMENT_EVENTS_QUERY = """
+query FulfillmentEvents($ids: [ID!]!) {
+  nodes(ids: $ids) {
+    ... on Fulfillment {
+      legacyResourceId
+      events(first: 10, sortKey: HAPPENED_AT, reverse: true) { edges { node { status } } }
+    }
+  }
+}
+"""
+
+
+def get_fulfillment_events_batch(fulfillment_ids: list) -> dict:
+    """{fulfillment_id: events} de varios fulfillments con una consulta nodes(ids:) por lote,
+    en vez de un GET REST por fulfillment. Los que Shopify no devuelva no aparecen."""
+    found = {}
+    for i in range(0, len(fulfillment_ids), SHOPIFY_NODES_BATCH):
+        chunk = fulfillment_ids[i : i + SHOPIFY_NODES_BATCH]
+        data = shopify_graphql(FULFILLMENT_EVENTS_QUERY, {"ids": [f"gid://shopify/Fulfillment/{fid}" for fid in chunk]})
+        for node in data.get("nodes") or []:
+            fid = gid_to_int((node or {}).get("legacyResourceId"))
+            if fid is not None:
+                found[fid] = graphql_events(node.get("events"))
+    return found
+
+
+def get_fulfillment_events(
+    order_id: int,
+    fulfillment_id: int,
+    etag: str | None = None,
+    cached_statuses: str | None = None,
+):
+    """Devuelve (events, etag). Con `etag` + `cached_statuses` (de la DB) hace un GET
+    condicional: si Shopify responde 304 se reconstruyen los eventos desde la caché."""
+    url = _EVENTS_URL_TEMPLATE.format(order_id=order_id, fulfillment_id=fulfillment_id)
+    headers = {}
+    if etag and cached_statuses is not None:
+        headers["If-None-Match"] = etag
+    r = shopify_request("GET", url, params={"fields": "status,created_at"}, headers=headers)
+    if r.status_code == 304:
+        return [{"status": st} for st in cached_statuses.split(",") if st], etag
     if r.status_code != 200:
         log(f"❌ Eventos Shopify {order_id}/{fulfillment_id}: {r.status_code} - {safe_snippet(r.text, 300)}")
-        return []
-    return r.json().get("events", []) or []
+        return [], None
+    return json_body(r).get("events", []) or [], r.headers.get("ETag")
 
 
-def fulfillment_has_status(events: list, status: str) -> bool:
-    return any(ev.get("status") == status for ev in (events or []))
+def event_statuses(events: list | None) -> set:
+    """Estados presentes en los eventos de un fulfillment (una sola pasada)."""
+    return {st for ev in (events or []) if (st := ev.get("status"))}
 
 
 def create_shopify_event(order_id: int, fulfillment_id: int, status: str, message: str, created_at_iso: str | None):
-    url = f"{SHOP_URL}/admin/api/{API_VERSION}/orders/{order_id}/fulfillments/{fulfillment_id}/events.json"
+    url = _EVENTS_URL_TEMPLATE.format(order_id=order_id, fulfillment_id=fulfillment_id)
     payload = {"event": {"status": status, "message": message}}
     if created_at_iso:
         payload["event"]["created_at"] = created_at_iso
@@ -153,10 +564,27 @@ def create_shopify_event(order_id: int, fulfillment_id: int, status: str, messag
 # =========================
 # CTT HELPERS
 # =========================
+# Formatos no ISO que se han visto en CTT (día/mes/año)
+_FALLBACK_DT_FORMATS = ("%d/%m/%Y %H:%M:%S", "%d/%m/%Y %H:%M", "%d/%m/%Y", "%d-%m-%Y %H:%M:%S")
+
+
 def parse_dt_any(dt_str: str | None):
     if not dt_str:
         return None
-    dt = parse(dt_str)
+    dt_str = dt_str.strip()
+    try:
+        # CTT y Shopify mandan ISO-8601 (también "Z" y "YYYY-MM-DD HH:MM:SS")
+        dt = datetime.fromisoformat(dt_str)
+    except ValueError:
+        for fmt in _FALLBACK_DT_FORMATS:
+            try:
+                dt = datetime.strptime(dt_str, fmt)
+                break
+            except ValueError:
+                continue
+        else:
+            # Fecha ilegible: quien llama usa su propio valor por defecto
+            return None
     if dt.tzinfo is None:
         dt = dt.replace(tzinfo=TZ)
     else:
@@ -164,32 +592,65 @@ def parse_dt_any(dt_str: str | None):
     return dt
 
 
+_STATUS_MAP = {
+    "En reparto": "out_for_delivery",
+    "Entrega hoy": "out_for_delivery",
+    "Entregado": "delivered",
+    "En tránsito": "in_transit",
+    "Recogido": "in_transit",
+    "Pendiente de recepción en CTT Express": "confirmed",
+    "Grabado": "confirmed",
+    "Reparto fallido": "failure",
+}
+
+
+def normalize_status(text: str) -> str:
+    """'  En Tránsito. ' -> 'en transito' (sin tildes, minúsculas, sin puntuación final)."""
+    text = unicodedata.normalize("NFKD", text or "").encode("ascii", "ignore").decode("ascii")
+    return " ".join(text.lower().split()).rstrip(".:;,!")
+
+
+# Mismas claves que _STATUS_MAP pero normalizadas: variantes de mayúsculas/tildes/espacios de CTT
+_NORMALIZED_STATUS_MAP = {normalize_status(k): v for k, v in _STATUS_MAP.items()}
+
+
+@functools.lru_cache(maxsize=None)
 def map_ctt_to_shopify(status: str) -> str:
-    status_map = {
-        "En reparto": "out_for_delivery",
-        "Entrega hoy": "out_for_delivery",
-        "Entregado": "delivered",
-        "En tránsito": "in_transit",
-        "En transito": "in_transit",
-        "Recogido": "in_transit",
-        "Pendiente de recepción en CTT Express": "confirmed",
-        "Reparto fallido": "failure",
-    }
-    return status_map.get(status, "in_transit")
+    return _NORMALIZED_STATUS_MAP.get(normalize_status(status), "in_transit")
+
+
+def decorrelated_jitter(prev: float, base: float, cap: float) -> float:
+    """Siguiente espera "decorrelated jitter": al azar entre base y 3× la anterior, con tope."""
+    return min(cap, random.uniform(base, prev * 3))
+
+
+def ctt_retry_wait(r: requests.Response, backoff: float) -> float:
+    """Espera antes de reintentar CTT: su Retry-After si lo manda (0 incluido), si no el
+    backoff; siempre con el tope CTT_MAX_BACKOFF para no dormir un worker una hora."""
+    retry_after = retry_after_seconds(r)
+    return min(CTT_MAX_BACKOFF, backoff if retry_after is None else retry_after)
 
 
 def get_ctt_status(tracking_number: str):
     """Devuelve {"status": str|None, "date": str|None} con retries."""
     url = CTT_API_URL + str(tracking_number)
     last_err = None
+    backoff = CTT_BASE_BACKOFF
 
     for attempt in range(1, CTT_MAX_RETRIES + 1):
         try:
+            CTT_LIMITER.acquire()
             r = CTT_SESSION.get(url, timeout=30, allow_redirects=True)
 
+            # El ritmo de CTT se adapta: 429/5xx lo bajan, las respuestas buenas lo recuperan
+            if r.status_code == 429 or r.status_code >= 500:
+                CTT_LIMITER.on_throttled()
+            elif r.status_code == 200:
+                CTT_LIMITER.on_success()
+
             if r.status_code == 429:
-                wait = min(CTT_BASE_BACKOFF * (2 ** (attempt - 1)), CTT_MAX_BACKOFF)
-                wait *= (0.85 + random.random() * 0.5)
+                backoff = decorrelated_jitter(backoff, CTT_BASE_BACKOFF, CTT_MAX_BACKOFF)
+                wait = ctt_retry_wait(r, backoff)
                 log(f"⏳ CTT {tracking_number}: 429. Reintento {attempt}/{CTT_MAX_RETRIES} en {wait:.2f}s")
                 time.sleep(wait)
                 continue
@@ -198,13 +659,14 @@ def get_ctt_status(tracking_number: str):
                 snippet = safe_snippet(r.text)
                 log(f"⚠️ CTT {tracking_number}: HTTP {r.status_code}. Body(220)={snippet!r}")
                 if 500 <= r.status_code < 600 and attempt < CTT_MAX_RETRIES:
-                    wait = min(CTT_BASE_BACKOFF * (2 ** (attempt - 1)), CTT_MAX_BACKOFF)
-                    time.sleep(wait)
+                    backoff = decorrelated_jitter(backoff, CTT_BASE_BACKOFF, CTT_MAX_BACKOFF)
+                    time.sleep(ctt_retry_wait(r, backoff))
                     continue
                 return {"status": None, "date": None}
 
-            text = (r.text or "").strip()
-            if not text:
+            # Comprobamos los bytes: r.text adivinaría la codificación (charset_normalizer)
+            # si CTT no la declara, y solo hace falta para el log de errores.
+            if not r.content.strip():
                 log(f"⚠️ CTT {tracking_number}: respuesta vacía ({attempt}/{CTT_MAX_RETRIES})")
                 if attempt < CTT_MAX_RETRIES:
                     time.sleep(CTT_BASE_BACKOFF * attempt)
@@ -212,9 +674,9 @@ def get_ctt_status(tracking_number: str):
                 return {"status": None, "date": None}
 
             try:
-                data = r.json()
+                data = json_body(r)
             except Exception:
-                snippet = safe_snippet(text)
+                snippet = safe_snippet(r.text.strip())
                 log(f"⚠️ CTT {tracking_number}: no JSON. Body(220)={snippet!r}")
                 if attempt < CTT_MAX_RETRIES:
                     time.sleep(CTT_BASE_BACKOFF * attempt)
@@ -236,8 +698,7 @@ def get_ctt_status(tracking_number: str):
 
         except requests.RequestException as e:
             last_err = e
-            wait = min(CTT_BASE_BACKOFF * (2 ** (attempt - 1)), CTT_MAX_BACKOFF)
-            wait *= (0.85 + random.random() * 0.5)
+            wait = backoff = decorrelated_jitter(backoff, CTT_BASE_BACKOFF, CTT_MAX_BACKOFF)
             log(f"⚠️ CTT {tracking_number}: red {attempt}/{CTT_MAX_RETRIES}: {e}. Espero {wait:.2f}s")
             time.sleep(wait)
 
@@ -245,6 +706,26 @@ def get_ctt_status(tracking_number: str):
     return {"status": None, "date": None}
 
 
+_CTT_RESULTS: dict[str, Future] = {}
+_CTT_RESULTS_LOCK = threading.Lock()
+
+
+def get_ctt_status_once(tracking_number: str):
+    """Como get_ctt_status, pero un solo GET por tracking y ejecución: si varios
+    fulfillments comparten tracking (aunque vayan en hilos distintos) esperan al primero."""
+    with _CTT_RESULTS_LOCK:
+        fut = _CTT_RESULTS.get(tracking_number)
+        owner = fut is None
+        if owner:
+            fut = _CTT_RESULTS[tracking_number] = Future()
+    if owner:
+        try:
+            fut.set_result(get_ctt_status(tracking_number))
+        except BaseException as e:
+            fut.set_exception(e)
+    return fut.result()
+
+
 # =========================
 # SQLITE STATE
 # =========================
@@ -256,6 +737,13 @@ def db_connect():
     return conn
 
 
+def db_add_missing_columns(conn: sqlite3.Connection, table: str, columns: dict):
+    existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    for name, decl in columns.items():
+        if name not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {decl}")
+
+
 def db_init(conn: sqlite3.Connection):
     conn.execute(
         """
@@ -276,16 +764,42 @@ def db_init(conn: sqlite3.Connection):
             next_check_at TEXT,
             last_error TEXT,
 
+            events_etag TEXT,
+            events_statuses TEXT,
+
             PRIMARY KEY (order_id, fulfillment_id)
         )
         """
     )
-    conn.execute("CREATE INDEX IF NOT EXISTS idx_shipments_pending ON shipments(is_delivered, next_check_at)")
+    # DBs creadas con versiones anteriores (la carpeta .state viene de la caché de CI)
+    db_add_missing_columns(conn, "shipments", {"events_etag": "TEXT", "events_statuses": "TEXT"})
+    # Índice parcial (solo no entregados, que son pocos) con la misma expresión del ORDER BY
+    # de db_get_pending: se recorre ya ordenado y se para en LIMIT, sin ordenar en memoria.
+    # Sustituye a idx_shipments_pending, que obligaba a ese ORDER BY con B-tree temporal.
+    conn.execute("DROP INDEX IF EXISTS idx_shipments_pending")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_shipments_due "
+        "ON shipments(COALESCE(last_checked_at, '1970-01-01')) WHERE is_delivered=0"
+    )
+    conn.execute("CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value TEXT)")
     conn.commit()
 
 
-def db_upsert_shipment(conn: sqlite3.Connection, order_id: int, fulfillment_id: int, tracking_number: str, shipped_at: str | None):
+def db_get_state(conn: sqlite3.Connection, key: str) -> str | None:
+    row = conn.execute("SELECT value FROM sync_state WHERE key=?", (key,)).fetchone()
+    return row[0] if row else None
+
+
+def db_set_state(conn: sqlite3.Connection, key: str, value: str | None):
     conn.execute(
+        "INSERT INTO sync_state (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+        (key, value),
+    )
+
+
+def db_upsert_shipments(conn: sqlite3.Connection, rows: list):
+    """rows: [(order_id, fulfillment_id, tracking_number, shipped_at), ...] en un solo executemany."""
+    conn.executemany(
         """
         INSERT INTO shipments (order_id, fulfillment_id, tracking_number, shipped_at)
         VALUES (?, ?, ?, ?)
@@ -293,9 +807,8 @@ def db_upsert_shipment(conn: sqlite3.Connection, order_id: int, fulfillment_id:
             tracking_number=excluded.tracking_number,
             shipped_at=COALESCE(shipments.shipped_at, excluded.shipped_at)
         """,
-        (order_id, fulfillment_id, tracking_number, shipped_at),
+        rows,
     )
-    conn.commit()
 
 
 def db_mark_delivered(conn: sqlite3.Connection, order_id: int, fulfillment_id: int, delivered_at_iso: str | None):
@@ -303,46 +816,59 @@ def db_mark_delivered(conn: sqlite3.Connection, order_id: int, fulfillment_id: i
         """
         UPDATE shipments
         SET is_delivered=1, delivered_at=?, next_check_at=NULL
-        WHERE order_id=? AND fulfillment_id=?
+        WHERE order_id=? AND fulfillment_id=? AND is_delivered=0
         """,
         (delivered_at_iso, order_id, fulfillment_id),
     )
-    conn.commit()
 
 
-def db_update_check(
-    conn: sqlite3.Connection,
-    order_id: int,
-    fulfillment_id: int,
-    *,
-    ctt_status: str | None,
-    ctt_event_at: str | None,
-    shopify_status: str | None,
-    next_check_at: str | None,
-    last_error: str | None,
-):
-    now_iso = datetime.now(TZ).isoformat()
-    conn.execute(
+def db_update_checks(conn: sqlite3.Connection, rows: list):
+    """Guarda varias revisiones con un solo executemany. Cada fila es un dict con las claves
+    del UPDATE (ver check_row): revisión, entrega (solo la primera vez, como
+    db_mark_delivered) y caché de eventos (None => se deja la que hay)."""
+    conn.executemany(
         """
         UPDATE shipments
-        SET last_checked_at=?,
-            next_check_at=?,
-            last_ctt_status=?,
-            last_ctt_event_at=?,
-            last_shopify_status=?,
-            last_error=?
-        WHERE order_id=? AND fulfillment_id=?
+        SET last_checked_at=:checked_at,
+            next_check_at=:next_check_at,
+            last_ctt_status=:ctt_status,
+            last_ctt_event_at=:ctt_event_at,
+            last_shopify_status=:shopify_status,
+            last_error=:last_error,
+            delivered_at=CASE WHEN :delivered AND is_delivered=0 THEN :delivered_at ELSE delivered_at END,
+            is_delivered=MAX(is_delivered, :delivered),
+            events_etag=COALESCE(:events_etag, events_etag),
+            events_statuses=COALESCE(:events_statuses, events_statuses)
+        WHERE order_id=:order_id AND fulfillment_id=:fulfillment_id
         """,
-        (now_iso, next_check_at, ctt_status, ctt_event_at, shopify_status, last_error, order_id, fulfillment_id),
+        rows,
     )
-    conn.commit()
 
 
-def db_get_pending(conn: sqlite3.Connection, limit: int = 2000):
+def db_get_pending(conn: sqlite3.Connection, limit: int = 2000, order_ids: list | None = None):
+    """Filas (sqlite3.Row) de envíos no entregados a los que ya les toca revisión.
+    Con 'order_ids' devuelve los no entregados de esos pedidos, toque o no."""
     now_iso = datetime.now(TZ).isoformat()
-    cur = conn.execute(
+    cur = conn.cursor()
+    cur.row_factory = sqlite3.Row
+    if order_ids:
+        marks = ",".join("?" * len(order_ids))
+        cur.execute(
+            f"""
+            SELECT order_id, fulfillment_id, tracking_number, last_shopify_status,
+                   last_ctt_status, last_ctt_event_at, last_error, events_etag, events_statuses
+            FROM shipments
+            WHERE is_delivered=0
+              AND order_id IN ({marks})
+            LIMIT ?
+            """,
+            (*order_ids, limit),
+        )
+        return cur.fetchall()
+    cur.execute(
         """
-        SELECT order_id, fulfillment_id, tracking_number, shipped_at, last_shopify_status, next_check_at
+        SELECT order_id, fulfillment_id, tracking_number, last_shopify_status,
+               last_ctt_status, last_ctt_event_at, last_error, events_etag, events_statuses
         FROM shipments
         WHERE is_delivered=0
           AND (next_check_at IS NULL OR next_check_at <= ?)
@@ -357,12 +883,44 @@ def db_get_pending(conn: sqlite3.Connection, limit: int = 2000):
 # =========================
 # MAIN LOGIC
 # =========================
-def discover_shipments_from_shopify(conn: sqlite3.Connection):
-    orders = get_fulfilled_orders(limit=MAX_SHOPIFY_ORDERS)
-    total_f = 0
+def discover_shipments_from_shopify(conn: sqlite3.Connection) -> dict:
+    """Mete/actualiza envíos en la DB. Devuelve {(order_id, fulfillment_id): {"events", "shipment_status"}}
+    con lo que ya vino en la respuesta (events solo en modo graphql; None en REST)."""
+    started_at = datetime.now(timezone.utc)
+    updated_at_min = None
+    # Marca = mayor updated_at visto en Shopify (reloj de Shopify, no el del runner)
+    watermark = None
+    if DISCOVERY_INCREMENTAL and not SYNC_ORDER_IDS:
+        watermark = db_get_state(conn, "last_orders_updated_at")
+    if watermark:
+        since = datetime.fromisoformat(watermark) - timedelta(minutes=DISCOVERY_OVERLAP_MINUTES)
+        updated_at_min = since.isoformat(timespec="seconds")
+    created_at_min = None
+    if DISCOVERY_CUTOFF_DAYS > 0:
+        created_at_min = (started_at - timedelta(days=DISCOVERY_CUTOFF_DAYS)).isoformat(timespec="seconds")
+
+    if SYNC_ORDER_IDS:
+        # Modo dirigido: solo los pedidos indicados; no toca la marca del barrido
+        orders = iter_fulfilled_orders(limit=len(SYNC_ORDER_IDS), ids=SYNC_ORDER_IDS)
+    elif SHOPIFY_DISCOVERY == "graphql":
+        orders = iter_fulfilled_orders_graphql(
+            limit=MAX_SHOPIFY_ORDERS, updated_at_min=updated_at_min, created_at_min=created_at_min
+        )
+    else:
+        orders = iter_fulfilled_orders(
+            limit=MAX_SHOPIFY_ORDERS, updated_at_min=updated_at_min, created_at_min=created_at_min
+        )
+    upserts = []
+    delivered = []
+    prefetched = {}
+    max_updated_at = None
+    skipped = 0
 
     for order in orders:
         order_id = order.get("id")
+        updated_at = parse_dt_any(order.get("updated_at"))
+        if updated_at and (max_updated_at is None or updated_at > max_updated_at):
+            max_updated_at = updated_at
         fulfillments = order.get("fulfillments") or []
         for f in fulfillments:
             fulfillment_id = f.get("id")
@@ -374,71 +932,161 @@ def discover_shipments_from_shopify(conn: sqlite3.Connection):
                 tracking_number = tlist[0] if tlist else None
 
             if not (order_id and fulfillment_id and tracking_number):
+                skipped += 1
                 continue
 
             # ✅ "Enviado" = shipped_at; si no existe, created_at.
             # ❌ NO usar updated_at porque cambia con eventos y rompe cálculos.
             shipped_at = f.get("shipped_at") or f.get("created_at")
 
-            db_upsert_shipment(conn, int(order_id), int(fulfillment_id), str(tracking_number), shipped_at)
-            total_f += 1
+            upserts.append((int(order_id), int(fulfillment_id), str(tracking_number), shipped_at))
+
+            # Si Shopify ya lo da por entregado (shipment_status o evento delivered en la
+            # propia respuesta) se cierra aquí: ni CTT ni GET de eventos.
+            if f.get("shipment_status") == "delivered" or "delivered" in event_statuses(f.get("events")):
+                delivered.append((int(order_id), int(fulfillment_id)))
+                continue
+
+            prefetched[(int(order_id), int(fulfillment_id))] = {
+                "events": f.get("events"),
+                "shipment_status": f.get("shipment_status"),
+            }
+
+    db_upsert_shipments(conn, upserts)
+    for order_id, fulfillment_id in delivered:
+        db_mark_delivered(conn, order_id, fulfillment_id, None)
+
+    log(
+        f"🧠 Descubiertos/actualizados {len(upserts)} fulfillments desde Shopify "
+        f"(MAX_SHOPIFY_ORDERS={MAX_SHOPIFY_ORDERS}, modo={'dirigido' if SYNC_ORDER_IDS else SHOPIFY_DISCOVERY}, desde={updated_at_min or 'siempre'})"
+    )
+    if skipped:
+        log(f"⏭️ {skipped} fulfillments sin tracking (o sin id) ignorados")
+    if max_updated_at and not SYNC_ORDER_IDS:
+        # Los incrementales llegan por updated_at ascendente: si MAX_SHOPIFY_ORDERS cortó, la
+        # marca queda en el último leído y el resto entra en la siguiente ejecución.
+        # Sin pedidos nuevos la marca no se mueve: la siguiente vez se pide desde el mismo punto
+        db_set_state(
+            conn, "last_orders_updated_at", max_updated_at.astimezone(timezone.utc).isoformat(timespec="seconds")
+        )
+    conn.commit()  # envíos descubiertos + marca, en una sola transacción
+    return prefetched
 
-    log(f"🧠 Descubiertos/actualizados {total_f} fulfillments desde Shopify (MAX_SHOPIFY_ORDERS={MAX_SHOPIFY_ORDERS})")
+
+def next_normal_check(now: datetime) -> str | None:
+    if NORMAL_RECHECK_MINUTES <= 0:
+        return None
+    return (now + timedelta(minutes=NORMAL_RECHECK_MINUTES)).isoformat()
 
 
 def process_one(
-    conn: sqlite3.Connection,
     order_id: int,
     fulfillment_id: int,
     tracking_number: str,
     last_shopify_status: str | None,
-):
+    events: list | None = None,
+    *,
+    last_ctt_status: str | None = None,
+    last_ctt_event_at: str | None = None,
+    last_error: str | None = None,
+    events_etag: str | None = None,
+    events_statuses: str | None = None,
+    shipment_status: str | None = None,
+) -> dict:
+    """Consulta Shopify/CTT (y crea el evento si toca). No toca la DB: devuelve
+    el resultado para que lo guarde el hilo principal (ver check_row).
+
+    `events`: eventos del fulfillment ya obtenidos en el descubrimiento; si es None
+    solo se piden a Shopify cuando CTT ha cambiado desde la última revisión
+    (last_ctt_status / last_ctt_event_at de la DB), con GET condicional (events_etag).
+    `shipment_status`: el del fulfillment en el descubrimiento (último evento en Shopify)."""
     now = datetime.now(TZ)
+    result = {
+        "order_id": order_id,
+        "fulfillment_id": fulfillment_id,
+        "checked_at": now.isoformat(),
+        "delivered": False,
+        "delivered_at": None,
+        "ctt_status": None,
+        "ctt_event_at": None,
+        "shopify_status": last_shopify_status,
+        "next_check_at": None,
+        "last_error": None,
+        "events_cache": None,  # (etag, "status1,status2") si cambió lo que sabemos de los eventos
+    }
+    # Estados que ya sabemos que existen en Shopify (los eventos no se borran, así que
+    # la caché de la DB puede quedarse corta pero nunca sobra)
+    known_statuses = set(events_statuses.split(",")) if events_statuses else set()
+    cache_etag = events_etag
 
     # 1) Candado fuerte: si ya está delivered en Shopify, cerramos sin tocar CTT
-    events = get_fulfillment_events(order_id, fulfillment_id)
-    if fulfillment_has_status(events, "delivered"):
-        db_mark_delivered(conn, order_id, fulfillment_id, delivered_at_iso=None)
+    statuses = event_statuses(events) if events is not None else None
+    if statuses is not None and "delivered" in statuses:
         log(f"✅ {order_id}/{fulfillment_id} ya estaba delivered en Shopify. Cierro seguimiento.")
-        db_update_check(
-            conn,
-            order_id,
-            fulfillment_id,
-            ctt_status=None,
-            ctt_event_at=None,
-            shopify_status="delivered",
-            next_check_at=None,
-            last_error=None,
+        result.update(delivered=True, shopify_status="delivered")
+        return result
+
+    # Si el GET de eventos va a hacer falta seguro (primera revisión o la anterior falló,
+    # y sin shipment_status con el que poder evitarlo) lo lanzamos ya, en paralelo con CTT.
+    events_future = None
+    if events is None and not shipment_status and (not last_ctt_status or last_error):
+        events_future = EVENTS_LOOKUP_POOL.submit(
+            get_fulfillment_events, order_id, fulfillment_id, events_etag, events_statuses
         )
-        return
 
-    # 2) Consultar CTT
-    ctt = get_ctt_status(tracking_number)
-    time.sleep(CTT_THROTTLE_SECONDS)
+    # 2) Consultar CTT. "Entregado" es terminal: si ya lo vimos (y falló el POST a
+    #    Shopify, si no estaría cerrado) reutilizamos ese estado sin volver a llamar a CTT.
+    if last_ctt_status and map_ctt_to_shopify(last_ctt_status) == "delivered":
+        ctt = {"status": last_ctt_status, "date": last_ctt_event_at}
+    else:
+        ctt = get_ctt_status_once(tracking_number)
 
     ctt_status = ctt.get("status")
     ctt_event_str = ctt.get("date")
     ctt_dt = parse_dt_any(ctt_event_str) or now
 
     mapped_status = map_ctt_to_shopify(ctt_status) if ctt_status else None
-
-    # 3) Si CTT dice delivered => crear delivered (una vez) y cerrar
+    result.update(ctt_status=ctt_status, ctt_event_at=ctt_dt.isoformat())
+
+    # 3) Sin eventos precargados: si CTT no ha avanzado desde la última revisión (y esa
+    #    revisión no falló), Shopify ya está al día y nos ahorramos el GET de eventos.
+    if events is None:
+        unchanged = (
+            events_future is None
+            and ctt_status is not None
+            and ctt_status == last_ctt_status
+            and (ctt_event_str is None or result["ctt_event_at"] == last_ctt_event_at)
+            and not last_error
+        )
+        if unchanged:
+            result.update(ctt_event_at=last_ctt_event_at, next_check_at=next_normal_check(now))
+            return result
+
+        # Shopify ya tiene ese estado (último evento, o visto/creado en otra ejecución):
+        # ni GET de eventos ni POST
+        if mapped_status and (mapped_status == shipment_status or mapped_status in known_statuses):
+            if events_future is not None:
+                events_future.cancel()
+            if mapped_status == "delivered":
+                result.update(delivered=True, shopify_status="delivered")
+                return result
+            result.update(shopify_status=mapped_status, next_check_at=next_normal_check(now))
+            return result
+
+        if events_future is not None:
+            events, etag = events_future.result()
+        else:
+            events, etag = get_fulfillment_events(order_id, fulfillment_id, events_etag, events_statuses)
+        statuses = event_statuses(events)
+        if etag:
+            cache_etag = etag
+        if "delivered" in statuses:
+            log(f"✅ {order_id}/{fulfillment_id} ya estaba delivered en Shopify. Cierro seguimiento.")
+            result.update(delivered=True, shopify_status="delivered")
+            return result
+
+    # 4) Si CTT dice delivered => crear delivered (una vez) y cerrar
     if mapped_status == "delivered":
-        if fulfillment_has_status(events, "delivered"):
-            db_mark_delivered(conn, order_id, fulfillment_id, delivered_at_iso=ctt_dt.isoformat())
-            log(f"✅ {order_id}/{fulfillment_id} delivered ya existía en Shopify. Cierro seguimiento.")
-            db_update_check(
-                conn,
-                order_id,
-                fulfillment_id,
-                ctt_status=ctt_status,
-                ctt_event_at=ctt_dt.isoformat(),
-                shopify_status="delivered",
-                next_check_at=None,
-                last_error=None,
-            )
-            return
-
         ok, err = create_shopify_event(
             order_id,
             fulfillment_id,
@@ -447,43 +1095,20 @@ def process_one(
             created_at_iso=ctt_dt.isoformat(),
         )
         if ok:
-            db_mark_delivered(conn, order_id, fulfillment_id, delivered_at_iso=ctt_dt.isoformat())
             log(f"✅ DELIVERED {order_id}/{fulfillment_id} (tracking {tracking_number})")
-            db_update_check(
-                conn,
-                order_id,
-                fulfillment_id,
-                ctt_status=ctt_status,
-                ctt_event_at=ctt_dt.isoformat(),
-                shopify_status="delivered",
-                next_check_at=None,
-                last_error=None,
-            )
+            result.update(delivered=True, delivered_at=ctt_dt.isoformat(), shopify_status="delivered")
         else:
             log(f"❌ Error creando DELIVERED {order_id}/{fulfillment_id}: {err}")
-            next_check = (now + timedelta(minutes=10)).isoformat()
-            db_update_check(
-                conn,
-                order_id,
-                fulfillment_id,
-                ctt_status=ctt_status,
-                ctt_event_at=ctt_dt.isoformat(),
-                shopify_status=last_shopify_status,
-                next_check_at=next_check,
-                last_error=err,
-            )
-        return
+            result.update(next_check_at=(now + timedelta(minutes=10)).isoformat(), last_error=err)
+        return result
 
-    # 4) Idempotencia anti-WhatsApp:
+    # 5) Idempotencia anti-WhatsApp:
     #    - Solo crear evento si CAMBIA vs last_shopify_status
     #    - Y si NO existe ya en Shopify
-    error_msg = None
-    posted_status = last_shopify_status
-
     if mapped_status:
         if mapped_status != last_shopify_status:
-            if fulfillment_has_status(events, mapped_status):
-                posted_status = mapped_status
+            if mapped_status in statuses:
+                result["shopify_status"] = mapped_status
                 log(f"⏭️ {order_id}/{fulfillment_id} '{mapped_status}' ya existe en Shopify (no duplico).")
             else:
                 ok, err = create_shopify_event(
@@ -494,74 +1119,123 @@ def process_one(
                     created_at_iso=ctt_dt.isoformat(),
                 )
                 if ok:
-                    posted_status = mapped_status
+                    result["shopify_status"] = mapped_status
+                    statuses = statuses | {mapped_status}
                     log(f"✅ Evento '{mapped_status}' {order_id}/{fulfillment_id} (CTT: {ctt_status})")
                 else:
-                    error_msg = f"Shopify event '{mapped_status}' failed: {err}"
-                    log(f"❌ {error_msg}")
+                    result["last_error"] = f"Shopify event '{mapped_status}' failed: {err}"
+                    log(f"❌ {result['last_error']}")
 
-    # 5) Programar siguiente revisión
-    if NORMAL_RECHECK_MINUTES <= 0:
-        next_check = None
-    else:
-        next_check = (now + timedelta(minutes=NORMAL_RECHECK_MINUTES)).isoformat()
-
-    db_update_check(
-        conn,
-        order_id,
-        fulfillment_id,
-        ctt_status=ctt_status,
-        ctt_event_at=ctt_dt.isoformat() if ctt_dt else None,
-        shopify_status=posted_status,
-        next_check_at=next_check,
-        last_error=error_msg,
-    )
+    # 6) Guardar lo que sabemos de los eventos (si cambió) y programar siguiente revisión
+    cached = ",".join(sorted(known_statuses | statuses))
+    if cache_etag != events_etag or cached != (events_statuses or ""):
+        result["events_cache"] = (cache_etag, cached)
+    result["next_check_at"] = next_normal_check(now)
+    return result
+
+
+def check_row(result: dict) -> dict:
+    """Resultado de process_one -> fila para db_update_checks."""
+    etag, statuses = result.get("events_cache") or (None, None)
+    return {**result, "delivered": int(result["delivered"]), "events_etag": etag, "events_statuses": statuses}
 
 
 def main():
+    if not SHOP_URL:
+        raise RuntimeError("Falta SHOP_URL en el entorno")
     if not ACCESS_TOKEN:
         raise RuntimeError("Falta SHOPIFY_ACCESS_TOKEN en el entorno")
 
     log(
         f"🚀 Sync (sin incidencias) | SHOP_URL='{SHOP_URL}' | API_VERSION={API_VERSION} | TZ={TZ_NAME} | "
-        f"MAX_SHOPIFY_ORDERS={MAX_SHOPIFY_ORDERS}"
+        f"MAX_SHOPIFY_ORDERS={MAX_SHOPIFY_ORDERS} | SYNC_WORKERS={SYNC_WORKERS}"
+        + (f" | SYNC_ORDER_IDS={len(SYNC_ORDER_IDS)}" if SYNC_ORDER_IDS else "")
     )
 
+    _CTT_RESULTS.clear()  # la caché de CTT vale solo para esta pasada
     conn = db_connect()
     db_init(conn)
 
     # 1) Descubrir nuevos envíos (solo recientes en Shopify)
-    discover_shipments_from_shopify(conn)
+    prefetched = discover_shipments_from_shopify(conn)
 
     # 2) Procesar pendientes (la DB evita revisar entregados)
-    pending = db_get_pending(conn, limit=3000)
+    pending = db_get_pending(conn, limit=3000, order_ids=SYNC_ORDER_IDS)
     log(f"🔄 Pendientes a revisar (no entregados): {len(pending)}")
 
-    for (order_id, fulfillment_id, tracking_number, shipped_at, last_shopify_status, next_check_at) in pending:
-        if not tracking_number:
-            continue
-        try:
-            process_one(
-                conn,
-                int(order_id),
-                int(fulfillment_id),
-                str(tracking_number),
-                last_shopify_status=last_shopify_status,
-            )
-        except Exception as e:
-            log(f"❌ Excepción en {order_id}/{fulfillment_id}: {e}")
-            retry_at = (datetime.now(TZ) + timedelta(minutes=30)).isoformat()
-            db_update_check(
-                conn,
-                int(order_id),
-                int(fulfillment_id),
-                ctt_status=None,
-                ctt_event_at=None,
-                shopify_status=last_shopify_status,
-                next_check_at=retry_at,
-                last_error=str(e),
+    # Eventos que seguro harán falta (primera revisión o la anterior falló) y no vinieron en
+    # el descubrimiento: en modo graphql se piden en lote en vez de un GET por fulfillment.
+    batched_events = {}
+    if SHOPIFY_DISCOVERY == "graphql":
+        need = [
+            int(row["fulfillment_id"])
+            for row in pending
+            if row["tracking_number"]
+            and prefetched.get((int(row["order_id"]), int(row["fulfillment_id"])), {}).get("events") is None
+            and (not row["last_ctt_status"] or row["last_error"])
+        ]
+        if need:
+            try:
+                batched_events = get_fulfillment_events_batch(need)
+            except (requests.RequestException, RuntimeError, ValueError) as e:  # ValueError: cuerpo no JSON
+                log(f"⚠️ Eventos en lote ({len(need)}) fallaron: {e}. Se pedirán uno a uno.")
+
+    # Las consultas HTTP van en paralelo; SQLite solo se toca desde este hilo.
+    with ThreadPoolExecutor(max_workers=SYNC_WORKERS) as pool:
+        futures = {}
+        checked = []  # filas para db_update_checks, se vuelcan cada DB_COMMIT_EVERY
+        for row in pending:
+            if not row["tracking_number"]:
+                continue
+            order_id, fulfillment_id = int(row["order_id"]), int(row["fulfillment_id"])
+            pre = prefetched.get((order_id, fulfillment_id), {})
+            events = pre.get("events")
+            if events is None:
+                events = batched_events.get(fulfillment_id)
+            fut = pool.submit(
+                process_one,
+                order_id,
+                fulfillment_id,
+                str(row["tracking_number"]),
+                last_shopify_status=row["last_shopify_status"],
+                events=events,
+                shipment_status=pre.get("shipment_status"),
+                last_ctt_status=row["last_ctt_status"],
+                last_ctt_event_at=row["last_ctt_event_at"],
+                last_error=row["last_error"],
+                events_etag=row["events_etag"],
+                events_statuses=row["events_statuses"],
             )
+            futures[fut] = (order_id, fulfillment_id, row["last_shopify_status"])
 
+        for fut in as_completed(futures):
+            order_id, fulfillment_id, last_shopify_status = futures[fut]
+            try:
+                result = fut.result()
+            except Exception as e:
+                log(f"❌ Excepción en {order_id}/{fulfillment_id}: {e}")
+                now = datetime.now(TZ)
+                result = {
+                    "order_id": order_id,
+                    "fulfillment_id": fulfillment_id,
+                    "checked_at": now.isoformat(),
+                    "delivered": False,
+                    "delivered_at": None,
+                    "ctt_status": None,
+                    "ctt_event_at": None,
+                    "shopify_status": last_shopify_status,
+                    "next_check_at": (now + timedelta(minutes=30)).isoformat(),
+                    "last_error": str(e),
+                }
+            checked.append(check_row(result))
+            if len(checked) >= DB_COMMIT_EVERY:
+                db_update_checks(conn, checked)
+                conn.commit()
+                checked.clear()
+
+    db_update_checks(conn, checked)
+    conn.commit()
+    conn.execute("PRAGMA optimize")  # estadísticas para el planificador (ANALYZE solo si hace falta)
     conn.close()
     log("✅ Sync terminado")
 